@@ -1,15 +1,41 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Any, Callable, List, Mapping, Tuple, TypedDict
-import openrouteservice
-from openrouteservice.distance_matrix import distance_matrix
-from tqdm import tqdm
+from array import array
+from typing import Any, Callable, List, Mapping, Optional, Tuple, TypedDict
+from scipy.spatial import cKDTree
+from tqdm.asyncio import tqdm
+import aiohttp
+import asyncio
+import numpy as np
+import orjson
 import pandas as pd
+import hashlib
 import json
+import random
+import sqlite3
 import sys
-from LatLon23 import LatLon
-
+import time
+
+# Walking matrix endpoint of the local ORS instance
+ORS_MATRIX_URL = "http://localhost:8082/ors/v2/matrix/foot-walking"
+# Maximum number of requests sent to ORS concurrently
+MAX_CONCURRENCY = 64
+# Seconds until a single request to ORS times out
+REQUEST_TIMEOUT = 60
+# Seconds after which retrying a failing request is given up
+RETRY_TIMEOUT = 60
+# Statuses of ORS responses, which are worth retrying
+RETRIABLE_STATUSES = {429, 503}
+# Database persisting ORS responses across runs
+CACHE_PATH = "walk-cache.sqlite"
+# Mean earth radius in km
+EARTH_RADIUS = 6371.0
+# Maximum number of routes (sources x destinations) ORS computes per matrix request
+MAX_ROUTES = 2500
+# Size in degrees of the tiles, in which sources are batched together
+TILE_SIZE = 0.02
 
 # Quadtree implementation kindly taken from: https://github.com/kisv701/quadtree
+# It is kept as a library together with for_each_nearby_rect and is not used
+# by __main__, which finds nearby stops with find_nearby_pairs instead.
 
 
 # Helper functions
@@ -32,6 +58,8 @@ def is_point_in_circle(point, circle):
 
 # Class for holding a data point
 class Point:
+    __slots__ = ("x", "y", "value")
+
     def __init__(self, x, y, value=None):
         self.x = x
         self.y = y
@@ -42,7 +70,7 @@ class Point:
 class QuadTree:
     def __init__(
         self,
-        capacity=4,
+        capacity=64,
         bottomLeft=Point(-100, -100, None),
         topRight=Point(100, 100, None),
     ):
@@ -52,24 +80,33 @@ class QuadTree:
         self.northEast = None
         self.southWest = None
         self.southEast = None
+        self._leaf = True
 
         # Region covered is defined by lower left and upper right corner
         self.bottomLeft = bottomLeft
         self.topRight = topRight
 
-        self.points = []
+        # Points of a leaf are stored as separate arrays of their coordinates
+        # and values, so leaves can be filtered with numpy without a copy.
+        # Queries therefore return new Points with float coordinates instead
+        # of the inserted objects.
+        self.xs = array("d")
+        self.ys = array("d")
+        self.values = []
         self.capacity = capacity
 
     def add_point(self, point):
 
         if self.is_inside(point):  # Check if point is within this "quad"
             if (
-                self.is_leaf()
+                self._leaf
             ):  # Check if current quad is leaf, otherwise pass point onto children
                 if (
-                    len(self.points) < self.capacity
+                    len(self.values) < self.capacity
                 ):  # If we can take the new point, keep it,
-                    self.points.append(point)
+                    self.xs.append(point.x)
+                    self.ys.append(point.y)
+                    self.values.append(point.value)
 
                 else:  # If this quad can't take point, split this quad.
 
@@ -77,26 +114,27 @@ class QuadTree:
                     self.split()
 
                     # Step 2, Add all the points into the new children
-                    for p in self.points:
-                        self.northWest.add_point(p)
-                        self.northEast.add_point(p)
-                        self.southWest.add_point(p)
-                        self.southEast.add_point(p)
+                    for p in self._leaf_points(range(len(self.values))):
+                        self._insert_child(p)
 
-                    self.northWest.add_point(point)
-                    self.northEast.add_point(point)
-                    self.southWest.add_point(point)
-                    self.southEast.add_point(point)
+                    self._insert_child(point)
 
                     # Step 3, clear points from self.
-                    self.points = []
+                    self.xs = array("d")
+                    self.ys = array("d")
+                    self.values = []
 
             else:
                 # self is not a leaf, pass point onto children
-                self.northWest.add_point(point)
-                self.northEast.add_point(point)
-                self.southWest.add_point(point)
-                self.southEast.add_point(point)
+                self._insert_child(point)
+
+    def _insert_child(self, point):
+        # The quadrants are disjoint, so the midpoints determine the only candidate
+        if point.y >= self.y_mid:
+            child = self.northEast if point.x >= self.x_mid else self.northWest
+        else:
+            child = self.southEast if point.x >= self.x_mid else self.southWest
+        child.add_point(point)
 
     def get_points_in_rect(self, bottomLeft, topRight):
 
@@ -106,11 +144,16 @@ class QuadTree:
 
         result = []  # All the points in the rectangle
 
-        if self.is_leaf():
+        if self._leaf:
             # If we are a leaf node add all the points that fit in the rect
-            for p in self.points:
-                if is_point_in_rect(p, bottomLeft, topRight):
-                    result.append(p)
+            xs, ys = self._leaf_coords()
+            mask = (
+                (xs > bottomLeft.x)
+                & (xs < topRight.x)
+                & (ys > bottomLeft.y)
+                & (ys < topRight.y)
+            )
+            result.extend(self._leaf_points(np.flatnonzero(mask).tolist()))
 
         else:
             # If we are not a leaf node, add points from all children
@@ -122,25 +165,35 @@ class QuadTree:
         return result
 
     def get_points_in_circle(self, circle):
+        # Circle is represented by a Point where value is the radius,
+        # the squared radius is only computed once for the whole query.
+        return self._get_points_in_circle(
+            circle.x, circle.y, circle.value * circle.value
+        )
+
+    def _get_points_in_circle(self, cx, cy, r2):
 
         # If the rect is does not overlap this quad we can't find any points
-        if not self.is_overlapping_circle(circle):
+        if not self._is_overlapping_circle(cx, cy, r2):
             return []
 
         result = []  # All the points in the rectangle
 
-        if self.is_leaf():
-            # If we are a leaf node add all the points that fit in the rect
-            for p in self.points:
-                if is_point_in_circle(p, circle):
-                    result.append(p)
+        if self._leaf:
+            # If we are a leaf node add all the points that fit in the circle
+            xs, ys = self._leaf_coords()
+            dst_x = xs - cx
+            dst_y = ys - cy
+            # Pythagoras to check distance between circle and points.
+            mask = dst_x * dst_x + dst_y * dst_y < r2
+            result.extend(self._leaf_points(np.flatnonzero(mask).tolist()))
 
         else:
             # If we are not a leaf node, add points from all children
-            result.extend(self.northWest.get_points_in_circle(circle))
-            result.extend(self.northEast.get_points_in_circle(circle))
-            result.extend(self.southWest.get_points_in_circle(circle))
-            result.extend(self.southEast.get_points_in_circle(circle))
+            result.extend(self.northWest._get_points_in_circle(cx, cy, r2))
+            result.extend(self.northEast._get_points_in_circle(cx, cy, r2))
+            result.extend(self.southWest._get_points_in_circle(cx, cy, r2))
+            result.extend(self.southEast._get_points_in_circle(cx, cy, r2))
 
         return result
 
@@ -161,29 +214,36 @@ class QuadTree:
     def is_overlapping_circle(self, circle):
         # Given a circle, represented by a Point where value is the radius,
         # check if it is overlapping self.
+        return self._is_overlapping_circle(
+            circle.x, circle.y, circle.value * circle.value
+        )
 
-        test_x = circle.x
-        test_y = circle.y
+    def _is_overlapping_circle(self, cx, cy, r2):
+        # Same as is_overlapping_circle, with the circle given by its center
+        # and squared radius.
+
+        test_x = cx
+        test_y = cy
 
         # If the circle is left of the rect, test left edge of rect
-        if circle.x < self.bottomLeft.x:
+        if cx < self.bottomLeft.x:
             test_x = self.bottomLeft.x
 
         # If the circle is right of the rect, test right edge of rect
-        elif circle.x > self.topRight.x:
+        elif cx > self.topRight.x:
             test_x = self.topRight.x
 
         # If the circle is below the rect, test bottom edge.
-        if circle.y < self.bottomLeft.y:
+        if cy < self.bottomLeft.y:
             test_y = self.bottomLeft.y
-        elif circle.y > self.topRight.y:
+        elif cy > self.topRight.y:
             test_y = self.topRight.y
 
-        dst_x = test_x - circle.x
-        dst_y = test_y - circle.y
+        dst_x = test_x - cx
+        dst_y = test_y - cy
 
         # Pythagoras to check distance between circle and line to check against.
-        return dst_x * dst_x + dst_y * dst_y <= circle.value * circle.value
+        return dst_x * dst_x + dst_y * dst_y <= r2
 
     def split(self):
         x_low = self.bottomLeft.x
@@ -192,6 +252,8 @@ class QuadTree:
         y_high = self.topRight.y
         x_mid = self.bottomLeft.x + (self.topRight.x - self.bottomLeft.x) / 2
         y_mid = self.bottomLeft.y + (self.topRight.y - self.bottomLeft.y) / 2
+        self.x_mid = x_mid
+        self.y_mid = y_mid
         self.northWest = QuadTree(
             capacity=self.capacity,
             bottomLeft=Point(x_low, y_mid),
@@ -212,14 +274,18 @@ class QuadTree:
             bottomLeft=Point(x_mid, y_low),
             topRight=Point(x_high, y_mid),
         )
+        self._leaf = False
+
+    def _leaf_coords(self):
+        # Views sharing the memory of the coordinate arrays. The arrays can't be
+        # appended to while a view exists, so views must not outlive a query.
+        return np.frombuffer(self.xs), np.frombuffer(self.ys)
+
+    def _leaf_points(self, indices):
+        return [Point(self.xs[i], self.ys[i], self.values[i]) for i in indices]
 
     def is_leaf(self):
-        return (
-            self.northWest is None
-            and self.northEast is None
-            and self.southWest is None
-            and self.southEast is None
-        )
+        return self._leaf
 
     def is_inside(self, point):
         return (
@@ -242,20 +308,44 @@ def for_each_nearby_rect(
     offset: float,
     func: Callable[[Point, Point], None],
 ):
-    for center_point in centers:
-        center = LatLon(center_point.y, center_point.x)
-        right = center.offset(90, offset)
-        left = center.offset(270, offset)
-        top = center.offset(0, offset)
-        bottom = center.offset(180, offset)
-        bottom_left = Point(left.lon.decimal_degree, bottom.lat.decimal_degree)
-        top_right = Point(right.lon.decimal_degree, top.lat.decimal_degree)
+    lngs = np.array([c.x for c in centers], dtype=np.float64)
+    lats = np.array([c.y for c in centers], dtype=np.float64)
+
+    # Small-angle approximation of the offset in degrees, sufficient for a few km
+    km_per_degree = EARTH_RADIUS * np.pi / 180
+    dlat = offset / km_per_degree
+    dlng = offset / (km_per_degree * np.cos(np.radians(lats)))
+    bottom_lefts = np.column_stack((lngs - dlng, lats - dlat)).tolist()
+    top_rights = np.column_stack((lngs + dlng, lats + dlat)).tolist()
+
+    for center_point, bl, tr in zip(centers, bottom_lefts, top_rights):
+        bottom_left = Point(bl[0], bl[1])
+        top_right = Point(tr[0], tr[1])
         nearby: List[Point] = tree.get_points_in_rect(bottom_left, top_right)
         for n in nearby:
             func(center_point, n)
 
 
+# Returns all pairs (i, j) with i < j of the provided coordinates, which
+# great-circle distance is within offset. Offset is in km.
+def find_nearby_pairs(lngs: np.ndarray, lats: np.ndarray, offset: float) -> np.ndarray:
+    lng_rad = np.radians(lngs)
+    lat_rad = np.radians(lats)
+    # Points on the unit sphere, so the euclidean distance is the chord length
+    xyz = np.column_stack(
+        (
+            np.cos(lat_rad) * np.cos(lng_rad),
+            np.cos(lat_rad) * np.sin(lng_rad),
+            np.sin(lat_rad),
+        )
+    )
+    chord = 2 * np.sin(offset / (2 * EARTH_RADIUS))
+    return cKDTree(xyz).query_pairs(chord, output_type="ndarray")
+
+
 class Edge:
+    __slots__ = ("start", "end", "duration", "distance")
+
     start: str
     end: str
     duration: float
@@ -268,118 +358,273 @@ class Edge:
         self.distance = distance
 
 
+class Batch(TypedDict):
+    # Stops are referenced by their row in the input
+    sources: List[int]
+    destinations: List[int]
+    # Requested (source, destination) entries as indices into the lists above
+    pairs: List[Tuple[int, int]]
+
+
 class Request(TypedDict):
-    client: openrouteservice.Client
     coords: List[Tuple[float, float]]
     sources_idx: List[int]
     destinations_idx: List[int]
+    sources: List[str]
     destinations: List[str]
-    source: str
-
-
-def request_edge(request: Request) -> List[Edge]:
-    try:
-        matrix = distance_matrix(
-            request["client"],
-            request["coords"],
-            profile="foot-walking",
-            metrics=["distance", "duration"],
-            sources=request["sources_idx"],
-            destinations=request["destinations_idx"],
+    pairs: List[Tuple[int, int]]
+
+
+# Stores matrix responses of ORS in a sqlite database, keyed by the hash of
+# the request body. Remove the database when the ORS graph has changed.
+class MatrixCache:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS matrix (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[Mapping[str, Any]]:
+        row = self.db.execute(
+            "SELECT value FROM matrix WHERE key = ?", (key,)
+        ).fetchone()
+        if row == None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key: str, matrix: Mapping[str, Any]):
+        self.db.execute(
+            "INSERT OR REPLACE INTO matrix (key, value) VALUES (?, ?)",
+            (key, json.dumps(matrix)),
         )
-    except openrouteservice.exceptions.ApiError:
-        return []
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class MatrixError(Exception):
+    def __init__(self, error: str, retriable: bool):
+        super().__init__(error)
+        # Whether the request may succeed on another run
+        self.retriable = retriable
+
+
+# Posts the body to the ORS matrix endpoint, retrying overload responses and
+# connection errors with exponential backoff. Raises a MatrixError with the
+# last error once the request can't succeed.
+async def post_matrix(
+    session: aiohttp.ClientSession, body: Mapping[str, Any]
+) -> Mapping[str, Any]:
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            async with session.post(ORS_MATRIX_URL, json=body) as response:
+                if response.status == 200:
+                    return await response.json()
+                error = f"status {response.status}"
+                retriable = response.status in RETRIABLE_STATUSES
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = f"{type(e).__name__}: {e}"
+            retriable = True
+
+        delay = 0.5 * 1.5**attempt * (random.random() + 0.5)
+        if not retriable or time.monotonic() - start + delay > RETRY_TIMEOUT:
+            raise MatrixError(error, retriable)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def request_edge(
+    session: aiohttp.ClientSession, cache: MatrixCache, request: Request
+) -> List[Edge]:
+    body = {
+        "locations": request["coords"],
+        "metrics": ["distance", "duration"],
+        "sources": request["sources_idx"],
+        "destinations": request["destinations_idx"],
+    }
+    key = hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+    matrix = cache.get(key)
+    if matrix == None:
+        response_body = await post_matrix(session, body)
+        matrix = {
+            "durations": response_body["durations"],
+            "distances": response_body["distances"],
+        }
+        cache.put(key, matrix)
     edges = []
-    for i in range(len(request["destinations"])):
-        end = request["destinations"][i]
-        duration = matrix["durations"][0][i]
-        distance = matrix["distances"][0][i]
-        edges.append(Edge(request["source"], end, duration, distance))
+    for i, j in request["pairs"]:
+        start = request["sources"][i]
+        end = request["destinations"][j]
+        duration = matrix["durations"][i][j]
+        distance = matrix["distances"][i][j]
+        edges.append(Edge(start, end, duration, distance))
     return edges
 
 
+# Returns the edges of all requests, together with the number of requests
+# which failed after retrying and which were rejected by ORS.
+async def request_edges(
+    requests: List[Request], cache: MatrixCache, concurrency: int
+) -> Tuple[List[Edge], int, int]:
+    semaphore = asyncio.Semaphore(concurrency)
+    edges: List[Edge] = []
+    failed = 0
+    rejected = 0
+
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+
+        async def bounded_request_edge(request: Request) -> List[Edge]:
+            async with semaphore:
+                try:
+                    return await request_edge(session, cache, request)
+                except MatrixError as e:
+                    sources = request["sources"]
+                    shown = ", ".join(str(s) for s in sources[:3])
+                    if len(sources) > 3:
+                        shown += f" and {len(sources) - 3} more"
+                    tqdm.write(
+                        f"request for sources {shown} failed: {e}", file=sys.stderr
+                    )
+                    raise
+
+        futures = [bounded_request_edge(r) for r in requests]
+        for future in tqdm.as_completed(futures, total=len(futures)):
+            try:
+                edges.extend(await future)
+            except MatrixError as e:
+                if e.retriable:
+                    failed += 1
+                else:
+                    rejected += 1
+
+    return edges, failed, rejected
+
+
 def chunk(l: List[Any], size: int) -> List[List[Any]]:
-    result = []
-    current = []
-    for idx, item in enumerate(l):
-        if idx % size == 0:
-            if len(current) != 0:
-                result.append(current)
-            current = []
-        current.append(item)
-    if len(current) != 0:
-        result.append(current)
-    return result
+    return [l[i : i + size] for i in range(0, len(l), size)]
+
+
+# Packs the pairs of the given sources into as few matrix requests as
+# possible, with each matrix spanning at most max_routes entries. Sources
+# should be close to each other, so they share most of their destinations.
+def batch_sources(
+    sources: List[int], pair_map: Mapping[int, List[int]], max_routes: int
+) -> List[Batch]:
+    batches: List[Batch] = []
+    current = Batch(sources=[], destinations=[], pairs=[])
+    dest_idx: Mapping[int, int] = {}
+    for source in sources:
+        for destinations in chunk(pair_map[source], max_routes):
+            new_dests = sum(1 for d in destinations if d not in dest_idx)
+            routes = (len(current["sources"]) + 1) * (
+                len(current["destinations"]) + new_dests
+            )
+            if routes > max_routes and len(current["sources"]) != 0:
+                batches.append(current)
+                current = Batch(sources=[], destinations=[], pairs=[])
+                dest_idx = {}
+
+            i = len(current["sources"])
+            current["sources"].append(source)
+            for dest in destinations:
+                j = dest_idx.get(dest)
+                if j == None:
+                    j = len(current["destinations"])
+                    dest_idx[dest] = j
+                    current["destinations"].append(dest)
+                current["pairs"].append((i, j))
+    if len(current["sources"]) != 0:
+        batches.append(current)
+    return batches
 
 
 if __name__ == "__main__":
     df = pd.read_csv(sys.argv[1], sep=",", quotechar='"')
-    stop_map = {row["id"]: row for idx, row in df.iterrows()}
-
-    min_long = df["lng"].min()
-    min_lat = df["lat"].min()
-    max_long = df["lng"].max()
-    max_lat = df["lat"].max()
-
-    tree = QuadTree(
-        bottomLeft=Point(min_long, min_lat, None),
-        topRight=Point(max_long, max_lat, None),
-    )
-    for idx, row in df.iterrows():
-        tree.add_point(Point(row["lng"], row["lat"], row["id"]))
+    ids = df["id"].to_numpy()
+    coords_np = df[["lng", "lat"]].to_numpy()
 
     offset = 0.5
-    pairs: List[Tuple[str, str]] = []
-    centers = [Point(row["lng"], row["lat"], row["id"]) for idx, row in df.iterrows()]
-
-    def collect_pairs(center: Point, nearby: Point):
-        if nearby.value == center.value:
-            return
-        pairs.append((center.value, nearby.value))
-
-    for_each_nearby_rect(tree, centers, offset, collect_pairs)
-
-    # deduplicate
-    pairs = set((a, b) if a <= b else (b, a) for a, b in pairs)
-    # group by first stops name
-    pair_map: Mapping[str, List[str]] = {}
-    for pair in pairs:
+    nearby = find_nearby_pairs(coords_np[:, 0], coords_np[:, 1], offset)
+
+    # deduplicate on integer codes, sorted like the ids so pairs keep their order
+    codes, uniques = pd.factorize(ids, sort=True)
+    pairs = np.sort(codes[nearby], axis=1)
+    pairs = np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+    # continue on rows, using the last row of stops listed multiple times
+    rows = np.empty(len(uniques), dtype=np.int64)
+    rows[codes] = np.arange(len(codes))
+    # group by first stop
+    pair_map: Mapping[int, List[int]] = {}
+    for pair in rows[pairs].tolist():
         entry = pair_map.get(pair[0])
         if entry == None:
             pair_map[pair[0]] = [pair[1]]
         else:
             entry.append(pair[1])
 
-    edges: List[Edge] = []
     requests: List[Request] = []
-    client = openrouteservice.Client(base_url="http://localhost:8082/ors")
-    for source, all_destinations in pair_map.items():
-        for destinations in chunk(all_destinations, 99):
-            batch_size = len(destinations)
-            coords = [(stop_map[source].lng, stop_map[source].lat)]
-            for dest in destinations:
-                coords.append((stop_map[dest].lng, stop_map[dest].lat))
 
-            source_idx = [0]
-            dest_idx = [i + 1 for i in range(batch_size)]
+    # group sources by tile, as nearby sources share most of their destinations
+    tiles_np = np.round(coords_np / TILE_SIZE).astype(np.int64).tolist()
+    tiles: Mapping[Tuple[int, int], List[int]] = {}
+    for source in pair_map:
+        tile = tuple(tiles_np[source])
+        tiles.setdefault(tile, []).append(source)
+
+    for tile_sources in tiles.values():
+        for batch in batch_sources(tile_sources, pair_map, MAX_ROUTES):
+            # stops being both source and destination are only sent once
+            sources = np.array(batch["sources"], dtype=np.int64)
+            destinations = np.array(batch["destinations"], dtype=np.int64)
+            stops, stop_idx = np.unique(
+                np.concatenate((sources, destinations)), return_inverse=True
+            )
             requests.append(
                 Request(
-                    client=client,
-                    coords=coords,
-                    sources_idx=source_idx,
-                    destinations_idx=dest_idx,
-                    destinations=destinations,
-                    source=source,
+                    coords=coords_np[stops].tolist(),
+                    sources_idx=stop_idx[: len(sources)].tolist(),
+                    destinations_idx=stop_idx[len(sources) :].tolist(),
+                    sources=ids[sources].tolist(),
+                    destinations=ids[destinations].tolist(),
+                    pairs=batch["pairs"],
                 )
             )
 
-    with ThreadPoolExecutor() as pool:
-        futures = {pool.submit(request_edge, r): r for r in requests}
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            local_edges = future.result()
-            edges.extend(local_edges)
+    cache = MatrixCache(CACHE_PATH)
+    edges, failed, rejected = asyncio.run(
+        request_edges(requests, cache, MAX_CONCURRENCY)
+    )
+    cache.close()
+
+    # keep a previous walk.json instead of replacing it with an incomplete one
+    if failed != 0 or rejected != 0:
+        if failed != 0:
+            # failed responses are not cached, so a re-run only repeats those
+            print(
+                f"{failed} of {len(requests)} requests failed after retrying, "
+                "re-run to request them again",
+                file=sys.stderr,
+            )
+        if rejected != 0:
+            print(
+                f"{rejected} of {len(requests)} requests were rejected by ORS "
+                "and will be rejected again on a re-run",
+                file=sys.stderr,
+            )
+        print("walk.json was not written", file=sys.stderr)
+        sys.exit(1)
 
     edges = [e for e in edges if e.distance != None and e.duration != None]
 
-    with open("walk.json", "w", encoding="utf-8") as f:
-        json.dump([e.__dict__ for e in edges], f, ensure_ascii=False)
+    # write edges one by one, instead of building a list of dicts first
+    with open("walk.json", "wb") as f:
+        f.write(b"[")
+        for idx, e in enumerate(edges):
+            if idx != 0:
+                f.write(b",")
+            f.write(orjson.dumps({k: getattr(e, k) for k in Edge.__slots__}))
+        f.write(b"]")